@@ -1,6 +1,7 @@
-import pandas as pd
+import polars as pl
 import streamlit as st
 import os
+import hashlib
 import duckdb # Import DuckDB
 
 # --- Configuration ---
@@ -11,9 +12,133 @@ st.set_page_config(layout="wide", page_title="Caste Data Dashboard")
 # IMPORTANT: This will now be the direct public URL to your Parquet file.
 DATA_PATH = 'https://storage.googleapis.com/jati-data/new_replication_panel.parquet'
 
+# The only columns the dashboard reads. Everything else in the Parquet file is never downloaded.
+PANEL_COLUMNS = ['state', 'district', 'date_year', 'date_month', 'hh_id', 'caste', 'caste_category']
+
+# Local copy of the Parquet file. It is downloaded once and loaded into DuckDB from disk
+# instead of re-fetching the remote file over HTTP on each Streamlit rerun. The copy holds only
+# PANEL_COLUMNS, so its name carries a fingerprint of that list: changing the columns makes the
+# app download a fresh copy instead of reusing a stale one.
+LOCAL_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+PANEL_COLUMNS_KEY = hashlib.sha1(','.join(PANEL_COLUMNS).encode()).hexdigest()[:8]
+LOCAL_DATA_PATH = os.path.join(LOCAL_DATA_DIR, f'new_replication_panel.{PANEL_COLUMNS_KEY}.parquet')
+
+# Low-cardinality text columns that are stored as DuckDB ENUMs (one '<column>_t' type each)
+ENUM_COLUMNS = ['state', 'district', 'caste', 'caste_category']
+
+# --- DuckDB Tunables (adjust per deployment) ---
+# Optional overrides from the environment. When unset, DuckDB's own defaults apply, which already
+# respect the container's CPU and memory limits.
+# Worker threads for scans and aggregations, e.g. DUCKDB_THREADS=4.
+DUCKDB_THREADS = os.environ.get('DUCKDB_THREADS')
+# Upper bound on DuckDB's memory use, e.g. DUCKDB_MEMORY_LIMIT=2GB; beyond it DuckDB spills to disk.
+DUCKDB_MEMORY_LIMIT = os.environ.get('DUCKDB_MEMORY_LIMIT')
+
+# --- Download the Dataset Once ---
+@st.cache_resource(show_spinner="Downloading dataset...") # Run once per server process, not per rerun
+def download_data(url, local_path):
+    """
+    Copies PANEL_COLUMNS of the remote Parquet file to local disk if it is not already there and
+    returns the local path. DuckDB's httpfs extension reads the Parquet footer and then fetches only
+    the needed column chunks with HTTP range requests.
+    The file is written under a temporary name first so an interrupted download is never picked up.
+    """
+    if not os.path.exists(local_path):
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        tmp_path = local_path + '.part'
+        try:
+            with duckdb.connect(database=':memory:') as download_con:
+                download_con.execute("INSTALL httpfs; LOAD httpfs;")
+                download_con.execute(f"""
+                COPY (SELECT {', '.join(PANEL_COLUMNS)} FROM read_parquet('{url}'))
+                TO '{tmp_path}' (FORMAT PARQUET)
+                """)
+            os.replace(tmp_path, local_path)
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            st.error(f"Error downloading the dataset from {url}: {e}")
+            st.stop()
+    return local_path
+
 # --- Initialize DuckDB Connection ---
-# We'll use a simple in-memory connection for querying the Parquet file directly.
-con = duckdb.connect(database=':memory:', read_only=False)
+@st.cache_resource(show_spinner="Loading dataset...") # One connection and one loaded table per server process
+def get_con():
+    """
+    Returns the DuckDB connection shared by every session and rerun. On first use it downloads the
+    dataset, opens an in-memory connection and bulk-loads the Parquet file into a native 'panel' table.
+    Every query then runs against DuckDB's own columnar storage instead of re-decoding the Parquet file.
+    """
+    parquet_path = download_data(DATA_PATH, LOCAL_DATA_PATH)
+    connection = duckdb.connect(database=':memory:', read_only=False)
+    try:
+        if DUCKDB_THREADS:
+            connection.execute(f"SET threads TO {int(DUCKDB_THREADS)}")
+        if DUCKDB_MEMORY_LIMIT:
+            memory_limit = DUCKDB_MEMORY_LIMIT.replace("'", "''")
+            connection.execute(f"SET memory_limit = '{memory_limit}'")
+
+        # Each ENUM_COLUMNS value is dictionary-encoded as a small integer code. The values are
+        # declared in sorted order, so ORDER BY on an ENUM column stays alphabetical.
+        for column in ENUM_COLUMNS:
+            connection.execute(f"""
+            CREATE TYPE {column}_t AS ENUM (
+                SELECT DISTINCT {column} FROM read_parquet('{parquet_path}')
+                WHERE {column} IS NOT NULL ORDER BY {column}
+            )
+            """)
+
+        # Only PANEL_COLUMNS are projected out of the Parquet file, with the text columns cast to
+        # their ENUMs and year/month narrowed to SMALLINT/TINYINT. hh_id is only ever counted, so it
+        # is kept as a 64-bit hash ('hh_id_h') that gives COUNT(DISTINCT) fixed-width integer keys;
+        # NULLs stay NULL so COUNT still skips them. Monthly filters are answered from panel_cube, so
+        # the only query filtering raw rows selects one (state, district) across every period; rows
+        # are stored clustered on exactly those columns so the per-row-group min/max statistics
+        # (zone maps) let DuckDB skip every row group outside that district, the in-memory
+        # equivalent of reading a single state=/district= partition.
+        connection.execute(f"""
+        CREATE TABLE panel AS
+        SELECT
+            state::state_t AS state,
+            district::district_t AS district,
+            date_year::SMALLINT AS date_year,
+            date_month::TINYINT AS date_month,
+            CASE WHEN hh_id IS NOT NULL THEN hash(hh_id) END AS hh_id_h,
+            caste::caste_t AS caste,
+            caste_category::caste_category_t AS caste_category
+        FROM read_parquet('{parquet_path}')
+        ORDER BY state, district, date_year, date_month
+        """)
+
+        # Summary tables turn every dashboard click into a lookup instead of an aggregation.
+        # panel_cube holds household counts per month and district; they are plain counts, so any
+        # coarser month-level filter can re-aggregate them with SUM. It is clustered on its own
+        # filter columns, state, year and month.
+        connection.execute("""
+        CREATE TABLE panel_cube AS
+        SELECT state, date_year, date_month, district, caste, caste_category, COUNT(hh_id_h) AS cnt_any
+        FROM panel
+        GROUP BY ALL
+        ORDER BY state, date_year, date_month, district
+        """)
+
+        # Distinct counts cannot be summed across months, so the entire-panel count of unique
+        # households per state is precomputed separately.
+        connection.execute("""
+        CREATE TABLE panel_cube_state AS
+        SELECT state, caste, caste_category, COUNT(DISTINCT hh_id_h) AS cnt_uniq
+        FROM panel
+        GROUP BY ALL
+        ORDER BY state
+        """)
+
+        # Only switched off once the table is stored in sorted order. Every query orders its own
+        # output, so DuckDB is then free to pick fully parallel plans that do not track row order.
+        connection.execute("SET preserve_insertion_order = false")
+    except Exception as e:
+        st.error(f"Error loading the dataset into DuckDB: {e}")
+        st.stop()
+    return connection
 
 # --- Month Name Mapping ---
 MONTH_NAMES = {
@@ -21,35 +146,46 @@ MONTH_NAMES = {
     7: "July", 8: "August", 9: "September", 10: "October", 11: "November", 12: "December"
 }
 
-# --- Load Metadata for Dropdowns (optimized for Parquet) ---
-@st.cache_data # Cache the metadata loading
-def load_and_prepare_metadata(path):
+# --- Load Metadata for Dropdowns ---
+@st.cache_data(show_spinner=False) # Cache the metadata loading
+def load_and_prepare_metadata():
     """
-    Checks for file existence and loads unique values for state, year, and month dropdowns
-    directly from Parquet using DuckDB. Districts will be loaded dynamically per state.
+    Loads unique values for state, year, and month dropdowns from the 'panel' table
+    using DuckDB. Districts are served per state from the district lookup.
     """
     try:
-        # Use DuckDB to efficiently read distinct values for dropdowns from Parquet
-        # DuckDB can directly read from HTTP(s) paths
-        states = con.execute(f"SELECT DISTINCT state FROM read_parquet('{path}') ORDER BY state").fetchdf()['state'].tolist()
-        years = con.execute(f"SELECT DISTINCT date_year FROM read_parquet('{path}') ORDER BY date_year").fetchdf()['date_year'].tolist()
-        months = con.execute(f"SELECT DISTINCT date_month FROM read_parquet('{path}') ORDER BY date_month").fetchdf()['date_month'].tolist()
+        # A single scan of the table feeds every dropdown: the CTE collapses the rows into
+        # per (state, year, month) counts once, and the distinct lists and the most common state
+        # are then derived from that small intermediate result.
+        metadata_query = """
+        WITH counts AS MATERIALIZED (
+            SELECT state, date_year, date_month, COUNT(*) AS n
+            FROM panel
+            GROUP BY state, date_year, date_month
+        )
+        SELECT
+            (SELECT list(DISTINCT state ORDER BY state) FROM counts) AS states,
+            (SELECT list(DISTINCT date_year ORDER BY date_year) FROM counts) AS years,
+            (SELECT list(DISTINCT date_month ORDER BY date_month) FROM counts) AS months,
+            (SELECT state FROM counts GROUP BY state ORDER BY SUM(n) DESC LIMIT 1) AS mode_state;
+        """
+        # A cursor is a separate handle on the shared database, safe to use alongside other
+        # sessions; the with block closes it as soon as the result is fetched
+        with get_con().cursor() as con:
+            states, years, months, most_common_state = con.execute(metadata_query).fetchone()
+        states, years, months = states or [], years or [], months or []
 
-        # For pre-selecting the most common state, we still need a quick query.
-        try:
-            mode_state_query = f"SELECT state FROM read_parquet('{path}') GROUP BY state ORDER BY COUNT(*) DESC LIMIT 1"
-            mode_state_result = con.execute(mode_state_query).fetchdf()
-            most_common_state = mode_state_result['state'].iloc[0] if not mode_state_result.empty else (states[0] if states else None)
-        except Exception:
-            most_common_state = states[0] if states else None # Fallback if mode query fails
+        # Fallback if the file has no rows to derive a most common state from
+        if most_common_state is None:
+            most_common_state = states[0] if states else None
 
         return states, years, months, most_common_state
     except Exception as e:
-        st.error(f"Error preparing metadata from Parquet: {e}. Please ensure the Dropbox link is a direct download link and publicly accessible.")
+        st.error(f"Error preparing metadata: {e}. Please ensure the downloaded Parquet file is complete and readable.")
         st.stop()
 
-# Get the unique values for dropdowns and pre-selection from DuckDB queries on Parquet
-all_states, all_years, all_months, most_common_state_for_dropdown = load_and_prepare_metadata(DATA_PATH)
+# Get the unique values for dropdowns and pre-selection from DuckDB
+all_states, all_years, all_months, most_common_state_for_dropdown = load_and_prepare_metadata()
 
 # If no data loaded for dropdowns, stop the app.
 if not all_states or not all_years or not all_months:
@@ -93,28 +229,40 @@ selected_month = st.sidebar.selectbox(
     disabled=view_entire_panel # Disable if "View Entire Panel" is checked
 )
 
-# --- Dynamic District Loading ---
-@st.cache_data
-def get_districts_for_state(path, state):
+# --- District Lookup ---
+@st.cache_resource(show_spinner=False) # Shared, read-only dict; no per-rerun copy like st.cache_data
+def load_district_lookup():
     """
-    Loads unique districts for the selected state from the Parquet file.
-    Includes 'Entire State' option.
+    Materializes the distinct (state, district) pairs once as a small Arrow table and turns it
+    into a {state: [districts]} dict, so district dropdowns never query DuckDB.
     """
     try:
-        # Query DuckDB for districts specific to the selected state
-        district_query = f"SELECT DISTINCT district FROM read_parquet('{path}') WHERE state = '{state}' ORDER BY district;"
-        districts = con.execute(district_query).fetchdf()['district'].tolist()
-        
-        # Add 'Entire State' option at the beginning
-        if 'Entire State' not in districts:
-            districts.insert(0, 'Entire State')
-        return districts
+        with get_con().cursor() as con:
+            district_table = con.execute("""
+            SELECT DISTINCT state, district
+            FROM panel_cube
+            WHERE district IS NOT NULL
+            ORDER BY state, district;
+            """).fetch_arrow_table()
+
+        lookup = {}
+        for state, district in zip(district_table['state'].to_pylist(), district_table['district'].to_pylist()):
+            lookup.setdefault(state, []).append(district)
+        return lookup
     except Exception as e:
-        st.error(f"Error loading districts for '{state}': {e}")
-        return ['Entire State'] # Fallback
+        st.error(f"Error loading the district lookup: {e}")
+        st.stop()
+
+def get_districts_for_state(state):
+    """
+    Returns the districts of the selected state from the cached lookup.
+    Includes 'Entire State' option.
+    """
+    # A new list is built so the shared cached lists are never mutated
+    return ['Entire State'] + load_district_lookup().get(state, [])
 
 # Get districts relevant to the currently selected state
-all_districts_for_selected_state = get_districts_for_state(DATA_PATH, selected_state)
+all_districts_for_selected_state = get_districts_for_state(selected_state)
 
 # Dropdown for District
 selected_district = st.sidebar.selectbox(
@@ -123,67 +271,134 @@ selected_district = st.sidebar.selectbox(
     index=0 # 'Entire State' is always at index 0
 )
 
-# --- Data Processing with DuckDB on Parquet (Single Optimized Query) ---
-@st.cache_data # Cache the results of DuckDB queries for chosen filters
-def get_caste_distribution_duckdb_optimized(path, state, year, month, view_entire_panel_flag, district):
+# Checkbox for approximate unique-household counts (only used for a district's entire panel)
+district_panel_view = view_entire_panel and selected_district != 'Entire State'
+approximate_counts = st.sidebar.checkbox(
+    "Approximate counts",
+    value=False,
+    help="Estimates unique households with HyperLogLog when viewing a single district's entire panel. "
+         "Estimates can be off by several percent. All other views use precomputed exact counts.",
+    disabled=not district_panel_view # Only a district's entire panel counts unique households live
+)
+# Counts shown are estimates only when the approximation actually applies to this view
+counts_are_estimates = approximate_counts and district_panel_view
+
+# --- Data Processing with DuckDB (Single Optimized Query) ---
+# Every argument is a hashable scalar, so identical selections from any number of sessions share
+# one cache entry; max_entries bounds the memory held by the cached results.
+@st.cache_data(max_entries=512, show_spinner=False) # Cache the results of DuckDB queries for chosen filters
+def get_caste_distribution_duckdb_optimized(state, year, month, view_entire_panel_flag, district, approximate_counts_flag=False):
     """
-    Queries the Parquet file using DuckDB with a single, highly optimized SQL query
-    to get filtered data, caste distribution, percentage, and rank.
-    Counts unique households if 'view_entire_panel_flag' is true.
+    Queries DuckDB with a single SQL query to get the caste distribution, percentage, and rank.
+    A single month re-aggregates 'panel_cube' and the entire panel for a whole state reads
+    'panel_cube_state'; only a single district's entire panel counts unique households in 'panel',
+    estimated with APPROX_COUNT_DISTINCT if 'approximate_counts_flag' is true.
+    Returns the display-ready ranking table and the total number of households.
     """
     try:
-        where_clauses = [
-            f"state = '{state}'"
-        ]
-
-        # Determine if we count distinct hh_id or all hh_id based on panel view
-        count_hh_id_clause = "COUNT(DISTINCT hh_id)" if view_entire_panel_flag else "COUNT(hh_id)"
-        sum_count_over_clause = f"SUM({count_hh_id_clause}) OVER ()"
+        # Filter values are bound as '?' parameters, never formatted into the SQL string, and
+        # cast to the column's ENUM so the comparison runs on the integer codes
+        where_clauses = ["state = ?::state_t"]
+        params = [state]
+        by_district = bool(district and district != 'Entire State')
 
         if not view_entire_panel_flag:
-            where_clauses.append(f"date_year = {year}")
-            where_clauses.append(f"date_month = {month}")
-
-        if district and district != 'Entire State':
-            where_clauses.append(f"district = '{district}'")
+            where_clauses += ["date_year = ?", "date_month = ?"]
+            params += [year, month]
+        if by_district:
+            where_clauses.append("district = ?::district_t")
+            params.append(district)
 
         where_str = " AND ".join(where_clauses)
 
+        # Pick the smallest source that answers the filters, always as (caste, caste_category, cnt)
+        if not view_entire_panel_flag:
+            grouped_query = f"""
+                SELECT caste, caste_category, SUM(cnt_any)::BIGINT AS cnt
+                FROM panel_cube
+                WHERE {where_str}
+                GROUP BY caste, caste_category
+            """
+        elif not by_district:
+            grouped_query = f"""
+                SELECT caste, caste_category, cnt_uniq AS cnt
+                FROM panel_cube_state
+                WHERE {where_str}
+            """
+        else:
+            # Count unique households across every month and year of the panel. HyperLogLog
+            # avoids building an exact hash set of every hh_id, but its estimates can be off by
+            # several percent, enough to change the ranking of close jatis, so the dashboard
+            # marks these numbers as estimates.
+            distinct_count_clause = "APPROX_COUNT_DISTINCT(hh_id_h)" if approximate_counts_flag else "COUNT(DISTINCT hh_id_h)"
+            grouped_query = f"""
+                SELECT caste, caste_category, {distinct_count_clause} AS cnt
+                FROM panel
+                WHERE {where_str}
+                GROUP BY caste, caste_category
+            """
+
+        # The total is computed once from the grouped counts instead of a window over the counts
         query = f"""
+        WITH g AS ({grouped_query}),
+        t AS (SELECT SUM(cnt) AS total FROM g)
         SELECT
             caste,
             caste_category,
-            {count_hh_id_clause} AS "Households Count",
-            ROUND(CAST({count_hh_id_clause} AS DOUBLE) * 100.0 / {sum_count_over_clause}, 2) AS "Percentage (%)",
-            ROW_NUMBER() OVER (ORDER BY {count_hh_id_clause} DESC) AS "Rank"
+            cnt AS "Households Count",
+            ROUND(CAST(cnt AS DOUBLE) * 100.0 / total, 2) AS "Percentage (%)"
         FROM
-            read_parquet('{path}')
-        WHERE
-            {where_str}
-        GROUP BY
-            caste, caste_category
+            g, t
         ORDER BY
-            "Households Count" DESC;
+            cnt DESC;
         """
-        result_df = con.execute(query).fetchdf()
+        # The few result rows are handed from Arrow straight to Polars rather than built into a
+        # pandas frame; the ENUM columns come back as dictionary arrays and become categoricals
+        with get_con().cursor() as con:
+            result_df = pl.from_arrow(con.execute(query, params).fetch_arrow_table())
+
+        # The result has at most a few dozen rows already sorted by count, so the rank is
+        # simply the row position rather than a ROW_NUMBER() window inside DuckDB
+        result_df = result_df.with_row_index("Rank", offset=1)
 
         # Calculate total households based on the "Households Count" from the result_df
         # which will already be unique if view_entire_panel_flag is True
-        total_households_in_state = result_df["Households Count"].sum() if not result_df.empty else 0
-
-        return result_df, total_households_in_state
+        total_households_in_state = result_df["Households Count"].sum() if not result_df.is_empty() else 0
+
+        # Return the table already in display order and with display names, so the cached value
+        # holds only what is shown; the text columns are kept categorical to stay small
+        display_df = result_df.select([
+            'Rank',
+            'caste_category',
+            'caste',
+            'Households Count',
+            'Percentage (%)'
+        ]).rename({
+            'caste': 'Jati',
+            'Households Count': 'Number of Households',
+            'Percentage (%)': 'Percentage of Households',
+            'caste_category': 'Caste Category'
+        }).with_columns(pl.col('Jati', 'Caste Category').cast(pl.Categorical))
+
+        return display_df, total_households_in_state
 
     except Exception as e:
-        st.error(f"Error querying data with DuckDB (Parquet): {e}")
-        return pd.DataFrame(), 0 # Return empty DataFrame and 0 households on error
+        st.error(f"Error querying data with DuckDB: {e}")
+        return pl.DataFrame(), 0 # Return empty DataFrame and 0 households on error
 
 # Get results using the highly optimized DuckDB powered function
+# Inputs a view ignores are normalized so equivalent selections map to the same cache entry
 ranked_jatis, total_households_in_state = get_caste_distribution_duckdb_optimized(
-    DATA_PATH, selected_state, selected_year, selected_month, view_entire_panel, selected_district
+    selected_state,
+    None if view_entire_panel else selected_year,
+    None if view_entire_panel else selected_month,
+    view_entire_panel,
+    selected_district,
+    counts_are_estimates # Only set for a single district's entire panel, the one view it changes
 )
 
 # --- Display Results ---
-if ranked_jatis.empty:
+if ranked_jatis.is_empty():
     st.warning("No data found for the selected filters. Please adjust your selections.")
 else:
     location_text = f"in {selected_state}"
@@ -198,30 +413,18 @@ else:
 
     st.header(f"Data {location_text} {time_text}")
 
-    st.subheader(f"Total Households {location_text} {time_text}: {total_households_in_state}")
-
-    # Rename columns for clarity in the table display and reorder them as requested
-    ranked_jatis_display = ranked_jatis[[
-        'Rank',
-        'caste_category',
-        'caste',
-        'Households Count',
-        'Percentage (%)'
-    ]].rename(columns={
-        'caste': 'Jati',
-        'Households Count': 'Number of Households',
-        'Percentage (%)': 'Percentage of Households',
-        'caste_category': 'Caste Category'
-    })
+    # Approximate counts are marked with '≈' wherever they are shown
+    estimate_marker = "≈" if counts_are_estimates else ""
+    st.subheader(f"Total Households {location_text} {time_text}: {estimate_marker}{total_households_in_state}")
 
     # --- Dominant Jati Section ---
     st.markdown("---")
     st.subheader(f"Dominant Jati {location_text} {time_text}")
-    if not ranked_jatis.empty:
-        dominant_jati_info = ranked_jatis.iloc[0] # The results are already sorted by count descending
+    if not ranked_jatis.is_empty():
+        dominant_jati_info = ranked_jatis.row(0, named=True) # The results are already sorted by count descending
         st.info(f"""
-        The dominant Jati is **{dominant_jati_info['caste']}** (Caste Category: **{dominant_jati_info['caste_category']}**).
-        It represents **{dominant_jati_info['Percentage (%)']}%** of the households {location_text}
+        The dominant Jati is **{dominant_jati_info['Jati']}** (Caste Category: **{dominant_jati_info['Caste Category']}**).
+        It represents **{estimate_marker}{dominant_jati_info['Percentage of Households']}%** of the households {location_text}
         {time_text}.
         """)
     else:
@@ -231,7 +434,7 @@ else:
     st.markdown("---")
     st.subheader(f"Relative Rankings of Other Jatis {location_text} {time_text}")
     st.markdown(f"Here is a detailed breakdown of all jatis {location_text} {time_text}:")
-    st.dataframe(ranked_jatis_display, use_container_width=True)
+    st.dataframe(ranked_jatis, use_container_width=True)
 
     st.markdown("---")
     st.markdown("Data provided by the Consumption and Income Pyramids of the Consumer Pyramids Household Survey (CPHS).")